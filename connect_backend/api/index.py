@@ -1,98 +1,292 @@
+import asyncio
+import bisect
+import hashlib
+import hmac
+import json
+import logging
 import os
+import queue
+import threading
+import time
+from decimal import Decimal
+from logging.handlers import QueueHandler, QueueListener
+from typing import List, Optional
+
+import httpx
+import msgspec
+import requests
 import stripe
-from fastapi import FastAPI, Request, HTTPException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# 📝 Loggers ("webhook" for events, "api" for the other endpoints): records go
+# through a queue, a background thread does the I/O
+logger = logging.getLogger("webhook")
+api_logger = logging.getLogger("api")
+
+_log_queue = queue.SimpleQueue()
+for _logger in (logger, api_logger):
+    _logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    _logger.propagate = False
+    _logger.addHandler(QueueHandler(_log_queue))
+
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(
+    logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s")
+)
+_log_listener = QueueListener(_log_queue, _log_stream_handler)
+_log_listener.start()
+
 # 🔐 Load Stripe Secret Key
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
+# 🔌 Reuse one pooled HTTP session for every Stripe call (keep-alive, no TLS handshake per request)
+_stripe_session = requests.Session()
+_stripe_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=50,
+        max_retries=Retry(total=2, backoff_factor=0.1),
+    ),
+)
+
+# ⚡ Async Stripe calls go through one shared HTTP/2 httpx client
+# Relies on the private _client_async / _verify_ssl_certs of stripe==10.12.0's HTTPXClient
+class PooledHTTPXClient(stripe.HTTPXClient):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Replaces the parent's default AsyncClient, which never opened a connection
+        self._client_async = httpx.AsyncClient(
+            base_url="https://api.stripe.com",
+            verify=stripe.ca_bundle_path if self._verify_ssl_certs else False,
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        )
+
+
+_stripe_async_client = PooledHTTPXClient()
+
+stripe.default_http_client = stripe.RequestsClient(
+    session=_stripe_session,
+    verify_ssl_certs=True,
+    async_fallback_client=_stripe_async_client,
+)
+
 # 🏪 Zara Connected Account ID
 ZARA_ACCOUNT_ID = os.getenv("ZARA_ACCOUNT_ID")
 
-app = FastAPI()
+# 🔏 Webhook signing secrets (platform + Connect endpoints), read and keyed once at startup
+STRIPE_WEBHOOK_SECRETS = [
+    secret.strip()
+    for secret in os.getenv(
+        "STRIPE_WEBHOOK_SECRETS", os.getenv("STRIPE_WEBHOOK_SECRET", "")
+    ).split(",")
+    if secret.strip()
+]
+WEBHOOK_TOLERANCE = stripe.Webhook.DEFAULT_TOLERANCE
+
+_webhook_hmacs = [
+    hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+    for secret in STRIPE_WEBHOOK_SECRETS
+]
+
+
+def verify_webhook_signature(payload: bytes, sig_header):
+    try:
+        items = [i.split("=", 1) for i in sig_header.split(",")]
+        timestamp = int(next(v for k, v in items if k == "t"))
+        signatures = [v for k, v in items if k == "v1"]
+    except Exception:
+        raise stripe.error.SignatureVerificationError(
+            "Unable to extract timestamp and signatures from header",
+            sig_header,
+            payload,
+        )
+
+    if not _webhook_hmacs:
+        raise stripe.error.SignatureVerificationError(
+            "Webhook signing secret is not configured", sig_header, payload
+        )
+
+    # Header is parsed once above; try each secret and stop at the first match.
+    # Copy the pre-keyed HMACs instead of re-deriving the key for every event.
+    signed_prefix = b"%d." % timestamp
+    for webhook_hmac in _webhook_hmacs:
+        mac = webhook_hmac.copy()
+        mac.update(signed_prefix)
+        mac.update(payload)
+        expected_sig = mac.hexdigest()
+        if any(hmac.compare_digest(expected_sig, s) for s in signatures):
+            break
+    else:
+        raise stripe.error.SignatureVerificationError(
+            "No signatures found matching the expected signature for payload",
+            sig_header,
+            payload,
+        )
+
+    if timestamp < time.time() - WEBHOOK_TOLERANCE:
+        raise stripe.error.SignatureVerificationError(
+            "Timestamp outside the tolerance zone (%d)" % timestamp,
+            sig_header,
+            payload,
+        )
+
+
+# 🚦 Stay under Stripe's per-account request budget by queueing locally
+STRIPE_RATE_LIMIT = int(os.getenv("STRIPE_RATE_LIMIT", "25"))
+STRIPE_RATE_LIMIT_WAIT = float(os.getenv("STRIPE_RATE_LIMIT_WAIT", "2"))
+
+stripe_limiter = AsyncLimiter(STRIPE_RATE_LIMIT, 1)
+_stripe_pending = 0
+
+
+async def acquire_stripe_slot():
+    # Bound the queue up front: cancelling aiolimiter's acquire() leaks its waiter
+    global _stripe_pending
+    if stripe_limiter.has_capacity():
+        # Capacity available: acquire() returns without suspending
+        await stripe_limiter.acquire()
+        return
+    if _stripe_pending >= STRIPE_RATE_LIMIT * STRIPE_RATE_LIMIT_WAIT:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests, please retry shortly",
+            headers={"Retry-After": str(max(1, round(STRIPE_RATE_LIMIT_WAIT)))},
+        )
+    _stripe_pending += 1
+    try:
+        # Shielded so a client disconnect doesn't cancel acquire() either
+        await asyncio.shield(stripe_limiter.acquire())
+    finally:
+        _stripe_pending -= 1
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+
+@app.on_event("shutdown")
+async def close_stripe_clients():
+    await _stripe_async_client.close_async()
+    _stripe_session.close()
+    _log_listener.stop()
 
 
 # Allow frontend to call backend
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
 
+# Redirect URLs only depend on FRONTEND_URL, so build them once
+SUCCESS_URL = f"{FRONTEND_URL}/success?session_id={{CHECKOUT_SESSION_ID}}"
+CANCEL_URL = f"{FRONTEND_URL}/"
+PORTAL_RETURN_URL = f"{FRONTEND_URL}/success"
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[FRONTEND_URL, "http://localhost:5173", "http://localhost:3000"],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization", "Stripe-Signature"],
 )
 
+# Fee tiers in cents: <= $100 -> $10, <= $200 -> $15, above -> $20
+_FEE_TIERS = (10000, 20000)
+_FEES = (1000, 1500, 2000)
+
 def calculate_platform_fee(amount):
-    if amount <= 10000:
-        return 1000
-    elif amount <= 20000:
-        return 1500
-    else:
-        return 2000
+    return _FEES[bisect.bisect_left(_FEE_TIERS, amount)]
+
+# Health checks get the same bytes every time, so encode the response once
+_HEALTH_RESPONSE = ORJSONResponse(content={"message": "Server is running"})
 
 @app.get("/")
 def home():
-    return {"message": "Server is running"}
-
-from typing import List , Optional
+    return _HEALTH_RESPONSE
 
 # ----------- REQUEST MODELS -----------
-class CartItem(BaseModel):
+class CartItem(msgspec.Struct):
     name: str
-    price: float
+    price: Decimal
     quantity: int
     image: Optional[str] = None
 
-class CheckoutRequest(BaseModel):
+    def __post_init__(self):
+        # price: finite, ge=0, max_digits=10, decimal_places=2
+        if not self.price.is_finite():
+            raise ValueError("price must be a finite amount")
+        sign, digits, exponent = self.price.as_tuple()
+        if sign or len(digits) + max(exponent, 0) > 10 or exponent < -2:
+            raise ValueError(
+                "price must be a non-negative amount with at most 2 decimal places"
+            )
+
+class CheckoutRequest(msgspec.Struct):
     items: List[CartItem]
     customer_id: Optional[str] = None
 
-class PortalRequest(BaseModel):
+class PortalRequest(msgspec.Struct):
     customer_id: str
 
+
+async def decode_body(request: Request, model):
+    try:
+        return msgspec.json.decode(await request.body(), type=model)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
 # ----------- CREATE CHECKOUT SESSION -----------
 
+# Keys that are the same for every checkout; copied per request
+_SESSION_TEMPLATE = {
+    'payment_method_types': ['card'],
+    'mode': 'payment',
+    'invoice_creation': {"enabled": True},
+    'success_url': SUCCESS_URL,
+    'cancel_url': CANCEL_URL,
+}
+_TRANSFER_DATA = {'destination': ZARA_ACCOUNT_ID}
+
 @app.post("/create-checkout-session")
-def create_checkout_session(data: CheckoutRequest):
+async def create_checkout_session(request: Request):
+    data = await decode_body(request, CheckoutRequest)
+    await acquire_stripe_slot()
     try:
-        line_items = []
-        total_amount = 0
-        for item in data.items:
-            unit_amount = int(item.price * 100)
-            quantity = item.quantity
-            total_amount += unit_amount * quantity
-            line_items.append({
+        # Decimal prices make the cents conversion exact; convert each item once
+        unit_amounts = [int(item.price * 100) for item in data.items]
+        total_amount = sum(
+            unit_amount * item.quantity
+            for item, unit_amount in zip(data.items, unit_amounts)
+        )
+
+        line_items = [
+            {
                 'price_data': {
                     'currency': 'usd',
                     'product_data': {
                         'name': item.name,
                         'images': [item.image] if item.image else [],
                     },
-                    'unit_amount': int(item.price * 100),
+                    'unit_amount': unit_amount,
                 },
                 'quantity': item.quantity,
-            })
+            }
+            for item, unit_amount in zip(data.items, unit_amounts)
+        ]
 
         platform_fee = calculate_platform_fee(total_amount)
 
-        session_args = {
-            'payment_method_types': ['card'],
-            'line_items': line_items,
-            'mode': 'payment',
-            'invoice_creation': {"enabled": True},
-            'payment_intent_data': {
-                'application_fee_amount': platform_fee,
-                'transfer_data': {
-                    'destination': ZARA_ACCOUNT_ID,
-                },
-            },
-            'success_url': f"{FRONTEND_URL}/success?session_id={{CHECKOUT_SESSION_ID}}",
-            'cancel_url': f"{FRONTEND_URL}/",
+        session_args = _SESSION_TEMPLATE.copy()
+        session_args['line_items'] = line_items
+        session_args['payment_intent_data'] = {
+            'application_fee_amount': platform_fee,
+            'transfer_data': _TRANSFER_DATA,
         }
 
         if data.customer_id:
@@ -100,21 +294,33 @@ def create_checkout_session(data: CheckoutRequest):
         else:
             session_args['customer_creation'] = 'always'
 
-        session = stripe.checkout.Session.create(**session_args)
+        session = await stripe.checkout.Session.create_async(**session_args)
 
         return {"sessionId": session.id, "url": session.url}
 
     except Exception as e:
-        print(f"Error creating session: {str(e)}")
+        api_logger.warning("checkout_session_failed error=%s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 
 # ----------- RETRIEVE SESSION (For Customer ID) -----------
 
+# Completed sessions don't change, so the success page's polling can be served locally
+_session_cache = TTLCache(maxsize=10000, ttl=60)
+_MISSING = object()
+
 @app.get("/checkout-session")
-def get_checkout_session(sessionId: str):
+async def get_checkout_session(sessionId: str):
+    # Single lookup: the entry could expire between a membership test and __getitem__
+    cached = _session_cache.get(sessionId, _MISSING)
+    if cached is not _MISSING:
+        return {"customer_id": cached}
+
+    await acquire_stripe_slot()
     try:
-        session = stripe.checkout.Session.retrieve(sessionId)
+        session = await stripe.checkout.Session.retrieve_async(sessionId)
+        if session.status == "complete":
+            _session_cache[sessionId] = session.customer
         return {"customer_id": session.customer}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -123,108 +329,159 @@ def get_checkout_session(sessionId: str):
 # ----------- CREATE PORTAL SESSION -----------
 
 @app.post("/create-portal-session")
-def create_portal_session(data: PortalRequest):
+async def create_portal_session(request: Request):
+    data = await decode_body(request, PortalRequest)
+    await acquire_stripe_slot()
     try:
-        session = stripe.billing_portal.Session.create(
+        session = await stripe.billing_portal.Session.create_async(
             customer=data.customer_id,
-            return_url=f"{FRONTEND_URL}/success",
+            return_url=PORTAL_RETURN_URL,
         )
         return {"url": session.url}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
-# ----------- STRIPE WEBHOOK (IMPORTANT) -----------
 # ----------- STRIPE WEBHOOK (FULL CONNECT SUPPORT) -----------
 
 @app.post("/webhook")
-async def stripe_webhook(request: Request):
+async def stripe_webhook(request: Request, background_tasks: BackgroundTasks):
     payload = await request.body()
     sig_header = request.headers.get("stripe-signature")
-    endpoint_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
     try:
-        event = stripe.Webhook.construct_event(
-            payload,
-            sig_header,
-            endpoint_secret
-        )
-    except ValueError as e:
-        print("❌ Webhook Error: Invalid payload")
-        raise HTTPException(status_code=400, detail="Invalid payload")
+        # Only the HMAC check runs before the ACK; JSON parsing is deferred
+        verify_webhook_signature(payload, sig_header)
     except stripe.error.SignatureVerificationError as e:
-        print("❌ Webhook Error: Invalid signature")
+        logger.warning("webhook_invalid_signature")
         raise HTTPException(status_code=400, detail="Invalid signature")
 
-    connected_account = event.get("account", "platform")
+    # Step 3: ACK Stripe right away, parse and process the event after the response is sent
+    background_tasks.add_task(handle_webhook_payload, payload)
 
-    print("========================================")
-    print(f"🔔 Webhook Event Received")
-    print(f"📌 Event Type: {event['type']}")
-    print(f"🏪 Account ID: {connected_account}")
-    print("========================================")
-    
-    if event["type"] == "checkout.session.completed":
-        session = event["data"]["object"]
+    # Step 4: Return success response
+    return {"status": "success"}
 
-        print("✅ Checkout Session Completed")
-        print(f"Session ID: {session['id']}")
-        print(f"Customer ID: {session.get('customer')}")
-        print(f"Amount Total: {session.get('amount_total')}")
-        print(f"Payment Intent: {session.get('payment_intent')}")
 
-        # TODO: Save order in database
+# ----------- WEBHOOK EVENT HANDLERS -----------
 
+# Event IDs reserved or handled recently (handlers run in the threadpool, hence the lock)
+_seen_events = TTLCache(maxsize=10000, ttl=3600)
+_seen_events_lock = threading.Lock()
 
-    # Payment succeeded
-    elif event["type"] == "payment_intent.succeeded":
-        payment_intent = event["data"]["object"]
+def _on_checkout(event, connected_account):
+    session = event["data"]["object"]
+    logger.info(
+        "checkout_completed account=%s session_id=%s customer=%s amount=%s payment_intent=%s",
+        connected_account,
+        session["id"],
+        session.get("customer"),
+        session.get("amount_total"),
+        session.get("payment_intent"),
+    )
 
-        print("💰 Payment Intent Succeeded")
-        print(f"PaymentIntent ID: {payment_intent['id']}")
-        print(f"Amount: {payment_intent['amount']}")
-        print(f"Currency: {payment_intent['currency']}")
-        print(f"Customer: {payment_intent.get('customer')}")
+    # TODO: Save order in database
 
-        # TODO: Update payment status in database
 
+# Payment succeeded
+def _on_payment_intent(event, connected_account):
+    payment_intent = event["data"]["object"]
+    logger.info(
+        "payment_intent_succeeded account=%s payment_intent=%s amount=%s currency=%s customer=%s",
+        connected_account,
+        payment_intent["id"],
+        payment_intent["amount"],
+        payment_intent["currency"],
+        payment_intent.get("customer"),
+    )
 
-    # Charge succeeded
-    elif event["type"] == "charge.succeeded":
-        charge = event["data"]["object"]
+    # TODO: Update payment status in database
 
-        print("💳 Charge Succeeded")
-        print(f"Charge ID: {charge['id']}")
-        print(f"Amount: {charge['amount']}")
-        print(f"Transfer: {charge.get('transfer')}")
 
-        # TODO: Save charge info
+# Charge succeeded
+def _on_charge(event, connected_account):
+    charge = event["data"]["object"]
+    logger.info(
+        "charge_succeeded account=%s charge=%s amount=%s transfer=%s",
+        connected_account,
+        charge["id"],
+        charge["amount"],
+        charge.get("transfer"),
+    )
 
+    # TODO: Save charge info
 
-    # Transfer created (Connect transfer to Zara account)
-    elif event["type"] == "transfer.created":
-        transfer = event["data"]["object"]
 
-        print("🔁 Transfer Created to Connected Account")
-        print(f"Transfer ID: {transfer['id']}")
-        print(f"Amount: {transfer['amount']}")
-        print(f"Destination: {transfer['destination']}")
+# Transfer created (Connect transfer to Zara account)
+def _on_transfer_created(event, connected_account):
+    transfer = event["data"]["object"]
+    logger.info(
+        "transfer_created account=%s transfer=%s amount=%s destination=%s",
+        connected_account,
+        transfer["id"],
+        transfer["amount"],
+        transfer["destination"],
+    )
 
-        # TODO: Save transfer record
+    # TODO: Save transfer record
 
 
-    # Transfer paid
-    elif event["type"] == "transfer.paid":
-        transfer = event["data"]["object"]
+# Transfer paid
+def _on_transfer_paid(event, connected_account):
+    transfer = event["data"]["object"]
+    logger.info(
+        "transfer_paid account=%s transfer=%s amount=%s",
+        connected_account,
+        transfer["id"],
+        transfer["amount"],
+    )
 
-        print("🏦 Transfer Paid")
-        print(f"Transfer ID: {transfer['id']}")
-        print(f"Amount: {transfer['amount']}")
+    # TODO: Confirm transfer
 
-        # TODO: Confirm transfer
 
+def _on_unhandled(event, connected_account):
+    logger.info(
+        "unhandled_event account=%s type=%s", connected_account, event["type"]
+    )
 
-    else:
-        print(f"ℹ️ Unhandled event type: {event['type']}")
 
-    # Step 4: Return success response
-    return {"status": "success"}
+HANDLERS = {
+    "checkout.session.completed": _on_checkout,
+    "payment_intent.succeeded": _on_payment_intent,
+    "charge.succeeded": _on_charge,
+    "transfer.created": _on_transfer_created,
+    "transfer.paid": _on_transfer_paid,
+}
+
+
+def handle_webhook_payload(payload: bytes):
+    try:
+        obj = json.loads(payload)
+    except ValueError:
+        obj = None
+
+    if not (isinstance(obj, dict) and "id" in obj and "type" in obj):
+        logger.warning("webhook_invalid_payload")
+        return
+
+    event = stripe.Event.construct_from(obj, stripe.api_key)
+
+    # Stripe retries deliveries; check and reserve the id in one step so two
+    # concurrent deliveries of the same event can't both dispatch
+    with _seen_events_lock:
+        if event["id"] in _seen_events:
+            logger.info("duplicate_event id=%s", event["id"])
+            return
+        _seen_events[event["id"]] = True
+
+    try:
+        handle_event(event)
+    except Exception:
+        # Release the reservation so Stripe's next retry gets processed
+        with _seen_events_lock:
+            _seen_events.pop(event["id"], None)
+        raise
+
+
+def handle_event(event):
+    connected_account = event.get("account", "platform")
+    HANDLERS.get(event["type"], _on_unhandled)(event, connected_account)
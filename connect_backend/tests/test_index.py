@@ -0,0 +1,266 @@
+import asyncio
+import os
+import ssl
+import sys
+import time
+from decimal import Decimal
+
+os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_dummy")
+os.environ.setdefault("STRIPE_WEBHOOK_SECRETS", "whsec_test,whsec_connect")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import msgspec
+import pytest
+import stripe
+from aiolimiter import AsyncLimiter
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import index
+
+
+# ----------- STRIPE HTTP CLIENT -----------
+
+def _ssl_context(client):
+    return client._client_async._transport._pool._ssl_context
+
+
+def test_pooled_httpx_client_respects_verify_ssl_certs():
+    verified = index.PooledHTTPXClient()
+    unverified = index.PooledHTTPXClient(verify_ssl_certs=False)
+
+    assert _ssl_context(verified).verify_mode == ssl.CERT_REQUIRED
+    assert _ssl_context(unverified).verify_mode == ssl.CERT_NONE
+
+    for client in (verified, unverified):
+        asyncio.run(client.close_async())
+
+
+def test_pooled_httpx_client_closes_its_async_client():
+    client = index.PooledHTTPXClient()
+    pooled_client = client._client_async
+
+    asyncio.run(client.close_async())
+
+    assert pooled_client.is_closed
+    assert not hasattr(client, "_default_client_async")
+
+
+# ----------- STRIPE RATE LIMIT -----------
+
+def test_burst_within_wait_budget_is_queued_and_only_overflow_is_rejected(monkeypatch):
+    # 10 requests per 0.1 s with a 2 s budget: 10 pass at once, 20 queue, the rest get 429
+    limiter = AsyncLimiter(10, 0.1)
+    monkeypatch.setattr(index, "stripe_limiter", limiter)
+    monkeypatch.setattr(index, "STRIPE_RATE_LIMIT", 10)
+    monkeypatch.setattr(index, "STRIPE_RATE_LIMIT_WAIT", 2)
+
+    async def burst():
+        return await asyncio.gather(
+            *(index.acquire_stripe_slot() for _ in range(50)),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(burst())
+    served = [r for r in results if r is None]
+    rejected = [r for r in results if isinstance(r, HTTPException)]
+
+    assert len(served) == 30
+    assert len(rejected) == 20
+    assert all(r.status_code == 429 for r in rejected)
+    assert all(r.headers["Retry-After"] == "2" for r in rejected)
+    assert not limiter._waiters
+    assert index._stripe_pending == 0
+
+
+# ----------- REQUEST MODELS -----------
+
+def _decode_item(price):
+    body = b'{"name": "Shirt", "price": %s, "quantity": 1}' % price
+    return msgspec.json.decode(body, type=index.CartItem)
+
+
+@pytest.mark.parametrize("price", [b"19.99", b"0", b"\"12345678.90\""])
+def test_cart_item_accepts_valid_prices(price):
+    assert _decode_item(price).price == Decimal(price.strip(b'"').decode())
+
+
+@pytest.mark.parametrize(
+    "price", [b"1e11", b"\"1e400\"", b"\"NaN\"", b"\"Infinity\"", b"19.999", b"-1"]
+)
+def test_cart_item_rejects_invalid_prices(price):
+    with pytest.raises(msgspec.ValidationError, match="price must be"):
+        _decode_item(price)
+
+
+# ----------- PLATFORM FEE -----------
+
+@pytest.mark.parametrize(
+    "amount, fee",
+    [(0, 1000), (10000, 1000), (10001, 1500), (20000, 1500), (20001, 2000)],
+)
+def test_platform_fee_tier_boundaries_are_inclusive(amount, fee):
+    assert index.calculate_platform_fee(amount) == fee
+
+
+# ----------- RETRIEVE SESSION -----------
+
+def _fake_retrieve(monkeypatch, status, customer):
+    calls = []
+
+    async def retrieve_async(session_id):
+        calls.append(session_id)
+        return stripe.checkout.Session.construct_from(
+            {"id": session_id, "status": status, "customer": customer}, "sk_test"
+        )
+
+    monkeypatch.setattr(stripe.checkout.Session, "retrieve_async", retrieve_async)
+    return calls
+
+
+def test_complete_checkout_session_is_fetched_from_stripe_once(monkeypatch):
+    calls = _fake_retrieve(monkeypatch, "complete", "cus_1")
+    client = TestClient(index.app)
+
+    for _ in range(3):
+        response = client.get("/checkout-session", params={"sessionId": "cs_complete"})
+        assert response.json() == {"customer_id": "cus_1"}
+
+    assert calls == ["cs_complete"]
+
+
+def test_open_checkout_session_is_not_cached(monkeypatch):
+    calls = _fake_retrieve(monkeypatch, "open", None)
+    client = TestClient(index.app)
+
+    for _ in range(2):
+        response = client.get("/checkout-session", params={"sessionId": "cs_open"})
+        assert response.json() == {"customer_id": None}
+
+    assert calls == ["cs_open", "cs_open"]
+    assert "cs_open" not in index._session_cache
+
+
+# ----------- STRIPE WEBHOOK -----------
+
+@pytest.mark.parametrize(
+    "payload", [b"not json", b"[1, 2]", b'{"type": "charge.succeeded"}', b'{"id": "evt_1"}']
+)
+def test_webhook_payload_that_is_not_an_event_is_logged(payload, monkeypatch):
+    handled = []
+    warnings = []
+    monkeypatch.setattr(index, "handle_event", handled.append)
+    monkeypatch.setattr(index.logger, "warning", warnings.append)
+
+    index.handle_webhook_payload(payload)
+
+    assert handled == []
+    assert warnings == ["webhook_invalid_payload"]
+
+
+def _signature(payload, secret, timestamp):
+    return stripe.WebhookSignature._compute_signature(
+        "%d.%s" % (timestamp, payload.decode()), secret
+    )
+
+
+def _post_webhook(payload, sig_header):
+    # TestClient runs background tasks in-request and re-raises their errors
+    return TestClient(index.app).post(
+        "/webhook", content=payload, headers={"stripe-signature": sig_header}
+    )
+
+
+_EVENT = b'{"id": "evt_sig", "type": "charge.succeeded", "data": {"object": {"id": "ch_1", "amount": 5}}}'
+
+
+def test_signed_non_event_payload_is_acked_without_error():
+    payload = b"[1, 2]"
+    timestamp = int(time.time())
+    response = _post_webhook(
+        payload, f"t={timestamp},v1={_signature(payload, 'whsec_test', timestamp)}"
+    )
+
+    assert response.status_code == 200
+    assert response.json() == {"status": "success"}
+
+
+def test_webhook_signed_with_second_secret_is_accepted():
+    timestamp = int(time.time())
+    response = _post_webhook(
+        _EVENT, f"t={timestamp},v1={_signature(_EVENT, 'whsec_connect', timestamp)}"
+    )
+
+    assert response.status_code == 200
+
+
+def test_webhook_signed_with_unknown_secret_is_rejected():
+    timestamp = int(time.time())
+    response = _post_webhook(
+        _EVENT, f"t={timestamp},v1={_signature(_EVENT, 'whsec_other', timestamp)}"
+    )
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid signature"
+
+
+def test_webhook_outside_tolerance_is_rejected_even_with_valid_signature():
+    timestamp = int(time.time()) - index.WEBHOOK_TOLERANCE - 10
+    response = _post_webhook(
+        _EVENT, f"t={timestamp},v1={_signature(_EVENT, 'whsec_test', timestamp)}"
+    )
+
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "sig_header", ["", "v1=abc", "t=abc,v1=abc", "garbage"]
+)
+def test_webhook_with_malformed_signature_header_is_rejected(sig_header):
+    assert _post_webhook(_EVENT, sig_header).status_code == 400
+
+
+def test_webhook_without_signature_header_is_rejected():
+    response = TestClient(index.app).post("/webhook", content=_EVENT)
+
+    assert response.status_code == 400
+
+
+def test_webhook_matches_any_of_several_v1_signatures():
+    timestamp = int(time.time())
+    valid = _signature(_EVENT, "whsec_test", timestamp)
+    response = _post_webhook(
+        _EVENT, f"t={timestamp},v1={'0' * 64},v0=legacy,v1={valid}"
+    )
+
+    assert response.status_code == 200
+
+
+def test_redelivered_event_is_handled_once(monkeypatch):
+    handled = []
+    monkeypatch.setattr(index, "handle_event", handled.append)
+    payload = b'{"id": "evt_dup", "type": "charge.succeeded", "data": {"object": {}}}'
+
+    index.handle_webhook_payload(payload)
+    index.handle_webhook_payload(payload)
+
+    assert [event["id"] for event in handled] == ["evt_dup"]
+
+
+def test_failed_event_is_released_for_retry(monkeypatch):
+    calls = []
+
+    def flaky_handler(event):
+        calls.append(event["id"])
+        if len(calls) == 1:
+            raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(index, "handle_event", flaky_handler)
+    payload = b'{"id": "evt_retry", "type": "charge.succeeded", "data": {"object": {}}}'
+
+    with pytest.raises(RuntimeError):
+        index.handle_webhook_payload(payload)
+    index.handle_webhook_payload(payload)
+
+    assert calls == ["evt_retry", "evt_retry"]
+    assert "evt_retry" in index._seen_events